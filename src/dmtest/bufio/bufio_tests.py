@@ -9,6 +9,7 @@ import enum
 import logging as log
 import mmap
 import os
+import queue
 import random
 import struct
 import threading
@@ -17,6 +18,11 @@ import time
 from contextlib import contextmanager
 
 
+# Instructions are variable length: a one byte opcode followed by its
+# operands, packed in native byte order with no padding.  Jump targets
+# are byte offsets into the program.  This layout is decoded by the
+# interpreter in the kernel's bufio test target, so it can't change
+# without a matching change there.
 class Instructions(enum.IntEnum):
     I_HALT = 0
     I_LIT = 1
@@ -38,14 +44,63 @@ class Instructions(enum.IntEnum):
     I_CHECKPOINT = 17
 
 
+# Plain int copies of the opcodes, and precompiled structs for each
+# instruction layout, so emitting code avoids the enum lookup and
+# re-parsing the struct format on every instruction.
+I_HALT = int(Instructions.I_HALT)
+I_LIT = int(Instructions.I_LIT)
+I_SUB = int(Instructions.I_SUB)
+I_ADD = int(Instructions.I_ADD)
+I_NEW_BUF = int(Instructions.I_NEW_BUF)
+I_READ_BUF = int(Instructions.I_READ_BUF)
+I_GET_BUF = int(Instructions.I_GET_BUF)
+I_PUT_BUF = int(Instructions.I_PUT_BUF)
+I_MARK_DIRTY = int(Instructions.I_MARK_DIRTY)
+I_WRITE_ASYNC = int(Instructions.I_WRITE_ASYNC)
+I_WRITE_SYNC = int(Instructions.I_WRITE_SYNC)
+I_FLUSH = int(Instructions.I_FLUSH)
+I_FORGET = int(Instructions.I_FORGET)
+I_FORGET_RANGE = int(Instructions.I_FORGET_RANGE)
+I_LOOP = int(Instructions.I_LOOP)
+I_STAMP = int(Instructions.I_STAMP)
+I_VERIFY = int(Instructions.I_VERIFY)
+I_CHECKPOINT = int(Instructions.I_CHECKPOINT)
+
+_S_OP = struct.Struct("=B")
+_S_OP_REG = struct.Struct("=BB")
+_S_OP_REG_REG = struct.Struct("=BBB")
+_S_LIT = struct.Struct("=BIB")
+_S_FORGET = struct.Struct("=BI")
+_S_FORGET_RANGE = struct.Struct("=BII")
+_S_LOOP = struct.Struct("=BHB")
+_S_LIT_VAL = struct.Struct("=I")
+
+# The bufio test target reads programs from a single 4k write.
+MAX_PROGRAM_SIZE = 4096
+
+
 class BufioProgram:
     def __init__(self):
-        self._bytes = b""
-        self._labels = {}
+        self._buf = bytearray(MAX_PROGRAM_SIZE)
+        self._pos = 0
         self._reg_alloc = 0
 
+    def _emit(self, s, *args):
+        pos = self._pos
+        end = pos + s.size
+        if end > MAX_PROGRAM_SIZE:
+            raise ValueError("buffer is too large")
+
+        s.pack_into(self._buf, pos, *args)
+        self._pos = end
+
     def compile(self):
-        return self._bytes[:]
+        return bytes(self._buf[: self._pos])
+
+    # Returns a read only view of the code rather than a copy.  It
+    # is only valid until the program is next modified.
+    def code_view(self):
+        return memoryview(self._buf)[: self._pos].toreadonly()
 
     def alloc_reg(self):
         reg = self._reg_alloc
@@ -53,64 +108,79 @@ class BufioProgram:
         return reg
 
     def label(self):
-        return len(self._bytes)
+        return self._pos
+
+    def load(self, template):
+        if self._pos or self._reg_alloc:
+            raise ValueError("templates can only be loaded into an empty program")
+
+        self._buf[: template._pos] = template._buf[: template._pos]
+        self._pos = template._pos
+        self._reg_alloc = template._reg_alloc
+
+    # Changes the value of the lit instruction at addr.
+    def set_lit(self, addr, val):
+        if addr < 0 or addr + _S_LIT.size > self._pos or self._buf[addr] != I_LIT:
+            raise ValueError(f"no lit instruction at {addr}")
+
+        _S_LIT_VAL.pack_into(self._buf, addr + 1, val)
 
     def halt(self):
-        self._bytes += struct.pack("=B", Instructions.I_HALT)
+        self._emit(_S_OP, I_HALT)
 
     def lit(self, val, reg):
-        self._bytes += struct.pack("=BIB", Instructions.I_LIT, val, reg)
+        self._emit(_S_LIT, I_LIT, val, reg)
 
     def sub(self, reg1, v):
-        self._bytes += struct.pack("=BBB", Instructions.I_SUB, reg1, v)
+        self._emit(_S_OP_REG_REG, I_SUB, reg1, v)
 
     def add(self, reg1, v):
-        self._bytes += struct.pack("=BBB", Instructions.I_ADD, reg1, v)
+        self._emit(_S_OP_REG_REG, I_ADD, reg1, v)
 
     def inc(self, reg1):
         self.add(reg1, 1)
 
     def new_buf(self, block_reg, dest_reg):
-        self._bytes += struct.pack("=BBB", Instructions.I_NEW_BUF, block_reg, dest_reg)
+        self._emit(_S_OP_REG_REG, I_NEW_BUF, block_reg, dest_reg)
 
     def read_buf(self, block_reg, dest_reg):
-        self._bytes += struct.pack("=BBB", Instructions.I_READ_BUF, block_reg, dest_reg)
+        self._emit(_S_OP_REG_REG, I_READ_BUF, block_reg, dest_reg)
 
     def get_buf(self, block_reg, dest_reg):
-        self._bytes += struct.pack("=BBB", Instructions.I_GET_BUF, block_reg, dest_reg)
+        self._emit(_S_OP_REG_REG, I_GET_BUF, block_reg, dest_reg)
 
     def put_buf(self, reg):
-        self._bytes += struct.pack("=BB", Instructions.I_PUT_BUF, reg)
+        self._emit(_S_OP_REG, I_PUT_BUF, reg)
 
     def mark_dirty(self, reg):
-        self._bytes += struct.pack("=BB", Instructions.I_MARK_DIRTY, reg)
+        self._emit(_S_OP_REG, I_MARK_DIRTY, reg)
 
     def write_async(self):
-        self._bytes += struct.pack("=B", Instructions.I_WRITE_ASYNC)
+        self._emit(_S_OP, I_WRITE_ASYNC)
 
     def write_sync(self):
-        self._bytes += struct.pack("=B", Instructions.I_WRITE_SYNC)
+        self._emit(_S_OP, I_WRITE_SYNC)
 
     def flush(self):
-        self._bytes += struct.pack("=B", Instructions.I_FLUSH)
+        self._emit(_S_OP, I_FLUSH)
 
     def forget(self, block):
-        self._bytes += struct.pack("=BI", Instructions.I_FORGET, block)
+        self._emit(_S_FORGET, I_FORGET, block)
 
     def forget_range(self, block, len):
-        self._bytes += struct.pack("=BII", Instructions.I_FORGET_RANGE, block, len)
+        self._emit(_S_FORGET_RANGE, I_FORGET_RANGE, block, len)
 
     def loop(self, addr, count):
-        self._bytes += struct.pack("=BHB", Instructions.I_LOOP, addr, count)
+        self._emit(_S_LOOP, I_LOOP, addr, count)
 
     def stamp(self, buf_reg, pattern_reg):
-        self._bytes += struct.pack("=BBB", Instructions.I_STAMP, buf_reg, pattern_reg)
+        self._emit(_S_OP_REG_REG, I_STAMP, buf_reg, pattern_reg)
 
     def verify(self, buf_reg, pattern_reg):
-        self._bytes += struct.pack("=BBB", Instructions.I_VERIFY, buf_reg, pattern_reg)
+        self._emit(_S_OP_REG_REG, I_VERIFY, buf_reg, pattern_reg)
 
     def checkpoint(self, reg):
-        self._bytes += struct.pack("=BB", Instructions.I_CHECKPOINT, reg)
+        self._emit(_S_OP_REG, I_CHECKPOINT, reg)
 
 
 @contextmanager
@@ -124,21 +194,87 @@ def loop(p, nr_times):
         p.loop(addr, loop_counter)
 
 
-def exec_program(dev, program):
-    bytes = program.compile()
-    if len(bytes) > 4096:
-        raise ValueError("buffer is too large")
+# O_DIRECT needs a page aligned buffer, so each thread keeps an
+# anonymous mapping around to stage its programs in.  We remember how
+# much of it the last program used so only that needs clearing.
+_tls = threading.local()
 
-    fd = os.open(dev.path, os.O_DIRECT | os.O_WRONLY)
-    try:
-        # Map a single page of memory to the file
-        page_size = os.sysconf("SC_PAGE_SIZE")
-        with mmap.mmap(-1, page_size) as mem:
-            mem.write(bytes)
-            with utils.timed("bufio program"):
-                os.write(fd, mem)
-    finally:
-        os.close(fd)
+
+def _program_page():
+    if not hasattr(_tls, "mem"):
+        _tls.mem = mmap.mmap(-1, os.sysconf("SC_PAGE_SIZE"))
+        _tls.used = 0
+    return _tls.mem
+
+
+# fd must have been opened with O_DIRECT
+def exec_program(fd, program):
+    code = program.code_view()
+    nr_bytes = len(code)
+    mem = _program_page()
+    mem[:nr_bytes] = code
+
+    # clear out anything left by a longer, previous program
+    if _tls.used > nr_bytes:
+        mem[nr_bytes : _tls.used] = bytes(_tls.used - nr_bytes)
+    _tls.used = nr_bytes
+
+    with utils.timed("bufio program"):
+        os.pwrite(fd, mem, 0)
+
+
+# Worker threads are kept around between ThreadSets so each test doesn't
+# have to start new ones.  There are always at least as many idle workers
+# as queued jobs, so everything submitted together runs concurrently.
+_work = queue.SimpleQueue()
+_workers_lock = threading.Lock()
+_nr_idle_workers = 0
+
+
+class _Job:
+    def __init__(self, fn, args):
+        self.fn = fn
+        self.args = args
+        self.error = None
+        self.done = threading.Event()
+
+
+def _worker():
+    global _nr_idle_workers
+
+    while True:
+        job = _work.get()
+        try:
+            job.fn(*job.args)
+        except BaseException as e:
+            job.error = e
+
+        with _workers_lock:
+            _nr_idle_workers += 1
+        job.done.set()
+
+
+# Runs fn once for each set of args, all at the same time, and waits
+# for every one of them to complete before raising the first error.
+def _run_concurrently(fn, all_args):
+    global _nr_idle_workers
+
+    with _workers_lock:
+        nr_reused = min(len(all_args), _nr_idle_workers)
+        _nr_idle_workers -= nr_reused
+        for _ in range(len(all_args) - nr_reused):
+            threading.Thread(target=_worker, daemon=True).start()
+
+    jobs = [_Job(fn, args) for args in all_args]
+    for job in jobs:
+        _work.put(job)
+
+    for job in jobs:
+        job.done.wait()
+
+    for job in jobs:
+        if job.error:
+            raise job.error
 
 
 class Code:
@@ -160,6 +296,7 @@ class Code:
 class ThreadSet:
     def __init__(self, dev):
         self._dev = dev
+        self._fd = None
         self._programs = []
 
     def program(self):
@@ -169,23 +306,33 @@ class ThreadSet:
         self._programs.append(code)
 
     def __enter__(self):
+        self._fd = os.open(self._dev.path, os.O_DIRECT | os.O_WRONLY)
         return self
 
     def __exit__(self, exc_type, exc_value, traceback):
-        if exc_type:
+        fd, self._fd = self._fd, None
+        if fd is None:
             return
 
-        threads = []
+        try:
+            if not exc_type:
+                self._run(fd)
+        finally:
+            os.close(fd)
 
-        for code in self._programs:
-            tid = threading.Thread(target=exec_program, args=(self._dev, code))
-            threads.append(tid)
+    def _run(self, fd):
+        nr_programs = len(self._programs)
+        if nr_programs == 0:
+            return
 
-        for tid in threads:
-            tid.start()
+        if nr_programs == 1:
+            exec_program(fd, self._programs[0])
+            return
 
-        for tid in threads:
-            tid.join()
+        # The target runs a program to completion inside the write
+        # that submits it, so each program needs its own worker
+        # for them to run concurrently.
+        _run_concurrently(exec_program, [(fd, code) for code in self._programs])
 
 
 def _sys_param(name: str) -> str:
@@ -302,17 +449,31 @@ def t_empty_program(fix):
             pass
 
 
-def do_new_buf(p, base):
+# do_new_buf() and do_stamper() always emit the same code apart from a
+# couple of literals, so they're built once and then patched.
+def _emit_new_buf(p):
     block = p.alloc_reg()
     buf = p.alloc_reg()
 
-    p.lit(base, block)
+    base_addr = p.label()
+    p.lit(0, block)
 
     with loop(p, 1024):
         p.new_buf(block, buf)
         p.put_buf(buf)
         p.inc(block)
 
+    return base_addr
+
+
+_new_buf_template = BufioProgram()
+_new_buf_base = _emit_new_buf(_new_buf_template)
+
+
+def do_new_buf(p, base):
+    p.load(_new_buf_template)
+    p.set_lit(_new_buf_base, base)
+
 
 def t_new_buf(fix):
     nr_threads = 16
@@ -324,43 +485,15 @@ def t_new_buf(fix):
                 do_new_buf(p, t * nr_gets)
 
 
-def t_stamper(fix):
-    with bufio_tester(fix.cfg["data_dev"]) as tester:
-        with tester.program() as p:
-            block = p.alloc_reg()
-            buf = p.alloc_reg()
-            pattern = p.alloc_reg()
-
-            p.lit(0, block)
-            p.lit(random.randint(0, 1024), pattern)
-
-            with loop(p, 1024):
-                # stamp
-                p.new_buf(block, buf)
-                p.stamp(buf, pattern)
-                p.mark_dirty(buf)
-                p.put_buf(buf)
-
-                # write
-                p.write_sync()
-                p.forget(block)
-
-                # re-read and verify
-                p.read_buf(block, buf)
-                p.verify(buf, pattern)
-                p.put_buf(buf)
-
-                p.inc(block)
-                p.inc(pattern)
-
-
-def do_stamper(p, base):
+def _emit_stamper(p):
     block = p.alloc_reg()
     buf = p.alloc_reg()
     pattern = p.alloc_reg()
 
-    p.lit(base, block)
-    p.lit(random.randint(0, 1024), pattern)
+    base_addr = p.label()
+    p.lit(0, block)
+    pattern_addr = p.label()
+    p.lit(0, pattern)
 
     with loop(p, 1024):
         # stamp
@@ -381,6 +514,24 @@ def do_stamper(p, base):
         p.inc(block)
         p.inc(pattern)
 
+    return base_addr, pattern_addr
+
+
+_stamper_template = BufioProgram()
+_stamper_base, _stamper_pattern = _emit_stamper(_stamper_template)
+
+
+def do_stamper(p, base):
+    p.load(_stamper_template)
+    p.set_lit(_stamper_base, base)
+    p.set_lit(_stamper_pattern, random.getrandbits(10))
+
+
+def t_stamper(fix):
+    with bufio_tester(fix.cfg["data_dev"]) as tester:
+        with tester.program() as p:
+            do_stamper(p, 0)
+
 
 def t_many_stampers(fix):
     nr_threads = 16